@@ -1,95 +1,295 @@
-import json
+import functools
+import hashlib
 import logging
 import os
-from typing import Annotated, Union
-
-import uvicorn
-from fastapi import Body, Depends, FastAPI, Request
-from fastapi.responses import JSONResponse, RedirectResponse
-from models import BaseModel
-from peewee import ModelSelect
+from collections import defaultdict
+from contextlib import asynccontextmanager
+from decimal import Decimal
+from typing import List, Union
+
+import orjson
+from fastapi import APIRouter, Body, FastAPI, HTTPException, Request
+from fastapi.encoders import decimal_encoder
+from fastapi.responses import JSONResponse, RedirectResponse, Response
+from models import WORKERS, BaseModel, database
+from peewee import (
+    BackrefAccessor,
+    CompositeKey,
+    ForeignKeyAccessor,
+    ModelSelect,
+    chunked,
+)
 from starlette.datastructures import QueryParams
 
 logging.basicConfig(level=os.environ.get("LOGLEVEL", "INFO").upper())
 
 
-class IndentJSONResponse(JSONResponse):
-    def render(self, content):
-        return json.dumps(content, indent=4, ensure_ascii=False).encode("utf-8")
-
-
-def get_resources():
-    return {sub._meta.name: sub for sub in BaseModel.__subclasses__()}
-
+def _default(obj):
+    """Encode what orjson does not know, like Decimal from DecimalField"""
+    return decimal_encoder(obj) if isinstance(obj, Decimal) else str(obj)
 
-def get_resource(kind: str):
-    if kind in get_resources():
-        return get_resources()[kind]
-    raise NotImplementedError(f"Resource [{kind}] not supported yet")
-
-
-def get_instance(kind: str, id: Union[int, str]):
-    return get_resource(kind).get_by_id(id)
 
-
-def with_psf(select: ModelSelect, query: QueryParams, user_id: int):
-    page = int(query.get("page", 1))
-    size = int(query.get("size", 5))
-    if page > 100 or size > 100:
-        raise ValueError("page or size must be less than 100")
-
-    return {
-        "data": [
-            o.to_dict(user_id, only=query.get("fields", "").split(","))
-            for o in select.where(query.get("filter"))
-            .order_by(query.get("sort"))
-            .paginate(page, size)
-        ],
-        "pagination": {"page": page, "size": size},
-    }
+class FastJSONResponse(JSONResponse):
+    def render(self, content):
+        return orjson.dumps(content, default=_default)
 
 
-Resource = Annotated[type(BaseModel), Depends(get_resource)]
-Instance = Annotated[BaseModel, Depends(get_instance)]
+class IndentJSONResponse(JSONResponse):
+    def render(self, content):
+        return orjson.dumps(content, default=_default, option=orjson.OPT_INDENT_2)
 
-app = FastAPI(default_response_class=IndentJSONResponse)
 
+def respond(request: Request, content, pretty: bool) -> Response:
+    """Responses are compact by default, and indented with `?pretty=1`.
 
-@app.exception_handler(Exception)
-async def _(request: Request, exc: Exception):
-    return IndentJSONResponse({"error": str(exc), "type": exc.__class__.__name__})
+    The ETag is a hash of the body, so a client sending it back in
+    If-None-Match gets an empty 304 when nothing changed.
+    """
+    response_class = IndentJSONResponse if pretty else FastJSONResponse
+    response = response_class(content)
+    etag = f'W/"{hashlib.blake2b(response.body, digest_size=16).hexdigest()}"'
+    if_none_match = request.headers.get("if-none-match", "")
+    if etag in (tag.strip() for tag in if_none_match.split(",")):
+        return Response(status_code=304, headers={"ETag": etag})
+    response.headers["ETag"] = etag
+    return response
 
 
-@app.get("/users/me{path:path}")
-def _(request: Request, user: int = 0):
-    url = str(request.url).replace("/me", f"/{user}")
-    return RedirectResponse(url)
+def connected(func):
+    """Run the handler with a connection from the pool, and give it back
+    afterwards. Peewee connections are per thread, and FastAPI runs sync
+    handlers in a thread pool, so this wraps the handler itself."""
 
+    @functools.wraps(func)
+    def wrapper(*args, **kwargs):
+        with database.connection_context():
+            return func(*args, **kwargs)
 
-@app.get("/{kind}/{id}")
-def _(ins: Instance, user: int = 0):
-    return ins.to_dict(user)
+    return wrapper
 
 
-@app.get("/{kind}")
-def _(res: Resource, request: Request, user: int = 0):
-    return with_psf(res.select(), request.query_params, user)
+def get_resource(kind: str):
+    res = BaseModel.resources.get(kind)
+    if res is None:
+        raise NotImplementedError(f"Resource [{kind}] not supported yet")
+    return res
 
 
-@app.get("/{kind}/{id}/{edge}")
-def _(ins: Instance, edge: str, request: Request, user: int = 0):
-    return with_psf(getattr(ins, edge), request.query_params, user)
+def get_instance(kind: str, id: Union[int, str]):
+    return get_resource(kind).get_by_id(id)
 
 
-@app.post("/{kind}/{id}")
-def _(ins: Instance, user: int = 0, props: dict = Body()):
-    return ins.from_dict(props, user).save()
+def get_locked_instance(kind: str, id: Union[int, str]):
+    """Read the row with SELECT ... FOR UPDATE so concurrent writes to it
+    are serialized. It bypasses the cache, and must run in a transaction."""
+    res = get_resource(kind)
+    return res.select().where(res._meta.primary_key == id).for_update().get()
+
+
+def _eager(model, rows: list, includes: list, user_id: int) -> dict:
+    """Load the relations named in `includes` for all the rows at once,
+    with one IN query per relation instead of one query per row.
+
+    Forward foreign keys (like `sales_rep_employee_number` of customers)
+    map to a single object, backrefs (like `orders` of customers) map to
+    a list of objects. Returns a dict of relation name to a list of values
+    aligned with `rows`.
+    """
+    related = {}
+    for name in filter(None, includes):
+        accessor = model.__dict__.get(name)
+        if isinstance(accessor, ForeignKeyAccessor):
+            fk = accessor.field
+            ids = list({o.__data__.get(fk.name) for o in rows} - {None})
+            objs = fk.rel_model.select().where(fk.rel_field << ids) if ids else []
+            by_id = {o.__data__[fk.rel_field.name]: o.to_dict(user_id) for o in objs}
+            related[name] = [by_id.get(o.__data__.get(fk.name)) for o in rows]
+        elif isinstance(accessor, BackrefAccessor):
+            fk = accessor.field
+            ids = [o.__data__[fk.rel_field.name] for o in rows]
+            objs = fk.model.select().where(fk << ids) if ids else []
+            by_id = defaultdict(list)
+            for o in objs:
+                by_id[o.__data__[fk.name]].append(o.to_dict(user_id))
+            related[name] = [by_id[o.__data__[fk.rel_field.name]] for o in rows]
+        else:
+            raise NotImplementedError(f"Relation [{name}] not supported yet")
+    return related
+
+
+def _dicts(select: ModelSelect, fields: list) -> Union[ModelSelect, None]:
+    """Read rows as plain dicts of the readable fields, skipping Model
+    construction and to_dict(). Only possible when the model does not
+    override get_role(), so every row has the same readable fields.
+
+    Returns None if the rows must go through to_dict() instead.
+    """
+    model = select.model
+    if model.get_role is not BaseModel.get_role:
+        return None
+    only = {f.strip() for f in fields}
+    readable = [
+        model._meta.fields[name]
+        for name in model.readable_names(model.default_role)
+        if not any(only) or name in only
+    ]
+    return select.select(*readable).dicts() if readable else None
 
 
-@app.delete("/{kind}/{id}")
-def _(ins: Instance, user: int = 0):
-    return ins.from_dict({"deleted", True}, user).save()
+def with_psf(select: ModelSelect, query: QueryParams, user_id: int):
+    try:
+        page = int(query.get("page", 1))
+        size = int(query.get("size", 5))
+    except ValueError:
+        raise HTTPException(400, "page and size must be integers")
+    if not (1 <= page <= 100 and 1 <= size <= 100):
+        raise HTTPException(400, "page and size must be between 1 and 100")
+
+    fields = query.get("fields", "").split(",")
+    includes = query.get("include", "").split(",")
+    flt = query.get("filter")
+    srt = query.get("sort")
+    after = query.get("after")
+    pk = select.model._meta.primary_key
+    if after is not None and (srt or isinstance(pk, CompositeKey)):
+        raise HTTPException(400, "after needs a single primary key and no sort")
+
+    def paged(q: ModelSelect) -> ModelSelect:
+        # With `after`, seek by primary key instead of scanning OFFSET rows
+        q = q.where(flt)
+        if after is None:
+            return q.order_by(srt).paginate(page, size)
+        return q.where(pk > after if after else None).order_by(pk).limit(size)
+
+    if not any(includes) and (fast := _dicts(select, fields)) is not None:
+        data = list(paged(fast))
+    else:
+        rows = list(paged(select))
+        data = [o.to_dict(user_id, only=fields) for o in rows]
+        related = _eager(select.model, rows, includes, user_id)
+        for name, values in related.items():
+            for item, value in zip(data, values):
+                # Forward keys hidden from the user stay hidden
+                if name in item or name not in select.model._meta.fields:
+                    item[name] = value
+
+    if after is None:
+        return {"data": data, "pagination": {"page": page, "size": size}}
+    last = data[-1].get(pk.name) if len(data) == size else None
+    return {"data": data, "pagination": {"after": after, "next": last, "size": size}}
+
+
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    yield
+    database.close_all()
+
+
+router = APIRouter()
+
+
+@router.get("/users/me{path:path}")
+def _(path: str, request: Request, user: int = 0):
+    if path and not path.startswith("/"):
+        raise HTTPException(404)
+    return RedirectResponse(
+        request.url.replace(path=f"/users/{user}{path}"),
+        status_code=308,
+        headers={"Cache-Control": "private, max-age=60"},
+    )
+
+
+@router.get("/{kind}/{id}")
+@connected
+def _(
+    kind: str,
+    id: Union[int, str],
+    request: Request,
+    user: int = 0,
+    pretty: bool = False,
+):
+    return respond(request, get_instance(kind, id).to_dict(user), pretty)
+
+
+@router.get("/{kind}")
+@connected
+def _(kind: str, request: Request, user: int = 0, pretty: bool = False):
+    select = get_resource(kind).select()
+    return respond(request, with_psf(select, request.query_params, user), pretty)
+
+
+@router.get("/{kind}/{id}/{edge}")
+@connected
+def _(
+    kind: str,
+    id: Union[int, str],
+    edge: str,
+    request: Request,
+    user: int = 0,
+    pretty: bool = False,
+):
+    select = getattr(get_instance(kind, id), edge)
+    return respond(request, with_psf(select, request.query_params, user), pretty)
+
+
+@router.post("/{kind}")
+@connected
+def _(kind: str, user: int = 0, props: List[dict] = Body()):
+    res = get_resource(kind)
+    instances = [res().from_dict(p, user) for p in props]
+    fields = [
+        f
+        for f in res._meta.sorted_fields
+        if any(f.name in ins.__data__ for ins in instances)
+    ]
+    with database.atomic():
+        for batch in chunked(instances, 500):
+            rows = [ins.__data__ for ins in batch]
+            res.insert_many(rows, fields=fields).execute()
+    res.clear_cache(*(k for ins in instances for k in ins.cache_keys()), raw_key=True)
+    return len(instances)
+
+
+@router.post("/{kind}/{id}")
+@connected
+def _(kind: str, id: Union[int, str], user: int = 0, props: dict = Body()):
+    with database.atomic():
+        ins = get_locked_instance(kind, id).from_dict(props, user)
+        return ins.save(only=ins.dirty_fields)
+
+
+@router.delete("/{kind}/{id}")
+@connected
+def _(kind: str, id: Union[int, str], user: int = 0):
+    if "deleted" not in get_resource(kind)._meta.fields:
+        raise HTTPException(405, f"{kind} has no deleted field to soft delete")
+    ins = get_instance(kind, id).from_dict({"deleted": True}, user)
+    return ins.save(only=ins.dirty_fields)
+
+
+def create_app() -> FastAPI:
+    app = FastAPI(default_response_class=FastJSONResponse, lifespan=lifespan)
+    app.include_router(router)
+
+    @app.exception_handler(Exception)
+    async def _(request: Request, exc: Exception):
+        return FastJSONResponse({"error": str(exc), "type": exc.__class__.__name__})
+
+    return app
 
 
 if __name__ == "__main__":
-    uvicorn.run(app="main:app", host="0.0.0.0", reload=True)
+    import uvicorn
+
+    dev = os.environ.get("ENV") == "dev"
+    uvicorn.run(
+        app="main:create_app",
+        factory=True,
+        host="0.0.0.0",
+        port=8000,
+        loop="uvloop",
+        http="httptools",
+        workers=WORKERS,
+        reload=dev,
+        access_log=dev,
+    )
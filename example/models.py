@@ -1,5 +1,6 @@
+import os
+
 from peewee import (
-    MySQLDatabase,
     AutoField,
     CharField,
     DecimalField,
@@ -9,11 +10,20 @@ from peewee import (
     IntegerField,
     CompositeKey,
 )
+from playhouse.pool import PooledMySQLDatabase
 
 from piiwee import Model
 
-database = MySQLDatabase(
+# Each worker runs up to 40 sync handlers at once (AnyIO's default thread
+# limit), and all workers share MySQL's max_connections (151 by default).
+WORKERS = int(os.environ.get("WEB_CONCURRENCY", os.cpu_count()))
+MYSQL_MAX_CONNECTIONS = int(os.environ.get("MYSQL_MAX_CONNECTIONS", 151))
+
+database = PooledMySQLDatabase(
     "classicmodels",
+    max_connections=max(1, min(40, (MYSQL_MAX_CONNECTIONS - 1) // WORKERS)),
+    timeout=10,  # wait for a free connection instead of failing the request
+    stale_timeout=300,
     **{
         "charset": "utf8",
         "sql_mode": "PIPES_AS_CONCAT",
@@ -29,9 +39,19 @@ class UnknownField(object):
 
 
 class BaseModel(Model):
+    resources = {}
+
     class Meta:
         database = database
 
+    @classmethod
+    def validate_model(cls):
+        """Register every model by its name as a RESTful resource. Peewee
+        calls this once the class is fully built, so `_meta` is ready."""
+        super().validate_model()
+        if "resources" not in cls.__dict__:
+            cls.resources[cls._meta.name] = cls
+
 
 class Offices(BaseModel):
     address_line1 = CharField(column_name="addressLine1")
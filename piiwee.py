@@ -10,12 +10,22 @@ import hashlib
 import logging
 import operator
 import pickle
-import random
-from functools import partialmethod, reduce
+import threading
+from collections import OrderedDict
+from functools import lru_cache, partialmethod
 from itertools import combinations
 from typing import Dict, List, Union
 
-from peewee import OP, Expression, Field, Model as PeeweeModel, ModelSelect
+from peewee import (
+    OP,
+    ROW,
+    Expression,
+    Field,
+    FloatField,
+    Model as PeeweeModel,
+    ModelSelect,
+    Node,
+)
 
 __author__ = "Jianshuo Wang"
 __copyright__ = "Copyright 2023, Baixing.com"
@@ -72,33 +82,105 @@ def expr(exp: Union[ast.AST, Expression, str], model: PeeweeModel) -> Expression
         Expression: The peewee Expression
     """
     if isinstance(exp, str):
-        return expr(ast.parse(exp, mode="eval").body, model)
-    if isinstance(exp, ast.Constant):
-        return exp.value
-    if isinstance(exp, ast.Name):
-        return getattr(model, exp.id)
-    if isinstance(exp, (ast.Tuple, ast.List)):
-        return [expr(e, model) for e in exp.elts]
-    if isinstance(exp, ast.UnaryOp):
-        return (
-            expr(exp.operand, model).desc()
-            if isinstance(exp.op, ast.USub)
-            else expr(exp.operand, model).asc()
-        )
-    if isinstance(exp, ast.BoolOp):
-        elements = [expr(e, model) for e in exp.values]
-        return (
-            reduce(operator.and_, elements)
-            if isinstance(exp.op, ast.And)
-            else reduce(operator.or_, elements)
-        )
-    if isinstance(exp, ast.Compare):
-        return Expression(
-            expr(exp.left, model),
-            operator_name(exp.ops[0]),
-            expr(exp.comparators[0], model),
-        )
-    raise NotImplementedError(f"Expression [{exp}] not supported yet")
+        return compile_expr(exp, model)
+    handler = _EXPR_HANDLERS.get(type(exp))
+    if handler is None:
+        raise NotImplementedError(f"Expression [{exp}] not supported yet")
+    return handler(exp, model)
+
+
+def _expr_name(exp: ast.Name, model: PeeweeModel) -> Field:
+    if exp.id not in model._meta.fields:
+        raise AttributeError(f"Field [{exp.id}] not found in {model.__name__}")
+    return model._meta.fields[exp.id]
+
+
+def _expr_unary(exp: ast.UnaryOp, model: PeeweeModel) -> Expression:
+    operand = expr(exp.operand, model)
+    return operand.desc() if isinstance(exp.op, ast.USub) else operand.asc()
+
+
+def _expr_bool(exp: ast.BoolOp, model: PeeweeModel) -> Expression:
+    # Flatten "a and (b and c)" into one chain, then fold it left to right
+    is_and = isinstance(exp.op, ast.And)
+    values, stack = [], list(reversed(exp.values))
+    while stack:
+        value = stack.pop()
+        if isinstance(value, ast.BoolOp) and isinstance(value.op, type(exp.op)):
+            stack.extend(reversed(value.values))
+        else:
+            values.append(value)
+    result = expr(values[0], model)
+    for value in values[1:]:
+        result = result & expr(value, model) if is_and else result | expr(value, model)
+    return result
+
+
+def _expr_compare(exp: ast.Compare, model: PeeweeModel) -> Expression:
+    return Expression(
+        expr(exp.left, model),
+        operator_name(exp.ops[0]),
+        expr(exp.comparators[0], model),
+    )
+
+
+def _expr_sequence(exp: Union[ast.Tuple, ast.List], model: PeeweeModel) -> tuple:
+    return tuple(expr(e, model) for e in exp.elts)
+
+
+# One dict lookup on the node type, instead of a chain of isinstance()
+_EXPR_HANDLERS = {
+    ast.Constant: lambda exp, model: exp.value,
+    ast.Name: _expr_name,
+    ast.Tuple: _expr_sequence,
+    ast.List: _expr_sequence,
+    ast.UnaryOp: _expr_unary,
+    ast.BoolOp: _expr_bool,
+    ast.Compare: _expr_compare,
+}
+
+
+@lru_cache(maxsize=1024)
+def parse_expr(source: str) -> ast.AST:
+    """Parse a python style expression string, once for each string.
+    expr() only reads the tree, so one parse is shared by all models.
+
+    >>> parse_expr("age > 18") is parse_expr("age > 18")
+    True
+
+    Args:
+        source (str): the python style expression
+
+    Returns:
+        ast.AST: the body of the parsed expression
+    """
+    return ast.parse(source, mode="eval").body
+
+
+@lru_cache(maxsize=1024)
+def compile_expr(source: str, model: PeeweeModel) -> Expression:
+    """Parse and convert a string to a peewee expression, once for each
+    model and string. The same filter and sort strings come back with
+    most requests, and peewee expressions can be shared between queries.
+
+    >>> from peewee import IntegerField
+    >>> class User(Model):
+    ...     age = IntegerField()
+    >>> compile_expr("age > 18", User) is compile_expr("age > 18", User)
+    True
+    >>> compile_expr("__class__ == 1", User)
+    Traceback (most recent call last):
+    ...
+    AttributeError: Field [__class__] not found in User
+
+    Args:
+        source (str): the python style expression
+        model (Model): the model the names in the expression belong to
+
+    Returns:
+        Expression: The peewee Expression
+    """
+    return expr(parse_expr(source), model)
 
 
 def ensure_tuple(data) -> tuple:
@@ -119,6 +201,8 @@ def ensure_tuple(data) -> tuple:
     Returns:
         tuple: make sure the output is a tuple
     """
+    if type(data) is tuple:
+        return data
     if isinstance(data, (list, tuple)):
         return tuple(data)
     return (data,)
@@ -146,6 +230,9 @@ def field_eq(
     ...     Expression(User.age, "=", 18)), "age")
     18
 
+    >>> field_eq((User.age == 0) & (User.name == "John"), User.age)
+    0
+
     Args:
         exp (Union[Expression, Field]): The expression to get the value from
         field (Union[Field, str]): The name or Field representing the field
@@ -153,12 +240,149 @@ def field_eq(
     Returns:
         str | None: the value of the field, or None if not found
     """
+    target = field.name if isinstance(field, Field) else field.strip()
+    return collect_eq(exp).get(target)
+
+
+def collect_eq(exp: Expression, out: dict = None) -> dict:
+    """Collect the values of all "field = value" conditions that are
+    joined by AND in the expression, walking the expression only once.
+    The first condition wins if a field appears more than once.
+
+    >>> from peewee import CharField, IntegerField
+    >>> class User(Model):
+    ...     name = CharField()
+    ...     age = IntegerField()
+    >>> collect_eq((User.name == "John") & (User.age > 18))
+    {'name': 'John'}
+
+    Args:
+        exp (Expression): The expression to collect the values from
+        out (dict, optional): The dict to collect into. Defaults to None.
+
+    Returns:
+        dict: the field names and their values
+    """
+    out = {} if out is None else out
     if isinstance(exp, Expression):
         if exp.op == "AND":
-            return field_eq(exp.lhs, field) or field_eq(exp.rhs, field)
-        if exp.op == "=" and exp.lhs.name == field_names([field])[0]:
-            return exp.rhs
-    return None
+            collect_eq(exp.lhs, out)
+            collect_eq(exp.rhs, out)
+        elif exp.op == "=" and isinstance(exp.lhs, Field):
+            out.setdefault(exp.lhs.name, exp.rhs)
+    return out
+
+
+_MATCH_OPS = {
+    OP.EQ: operator.eq,
+    OP.NE: operator.ne,
+    OP.LT: operator.lt,
+    OP.LTE: operator.le,
+    OP.GT: operator.gt,
+    OP.GTE: operator.ge,
+    OP.IN: lambda value, rhs: value in rhs,
+    OP.NOT_IN: lambda value, rhs: value not in rhs,
+}
+
+
+def row_matcher(exp: Expression) -> callable:
+    """Build a Python predicate that tells whether a fetched row matches
+    the expression, so rows can be filtered without a query. The predicate
+    takes a dict of field names and values.
+
+    Only AND, OR, IS (NOT) NULL, and comparisons between a field and a
+    constant are supported. Strings are not supported either, since their
+    comparison depends on the collation of the database. The constant must
+    also be of the same type as the value in the row, since the database
+    converts mixed types, like Decimal and float, before it compares them.
+    Floats are not supported at all, since MySQL stores FLOAT in single
+    precision, and compares it differently from Python.
+
+    >>> from peewee import CharField, IntegerField
+    >>> class User(Model):
+    ...     name = CharField()
+    ...     age = IntegerField(null=True)
+    >>> match = row_matcher((User.age > 18) & User.id.in_([1, 2]))
+    >>> match({"id": 1, "age": 20}), match({"id": 3, "age": 20})
+    (True, False)
+    >>> match({"id": 1, "age": None})
+    False
+    >>> row_matcher(User.name == "John")
+    Traceback (most recent call last):
+    ...
+    NotImplementedError: Expression [John] not supported yet
+
+    >>> from decimal import Decimal
+    >>> from peewee import DecimalField
+    >>> class Product(Model):
+    ...     price = DecimalField()
+    >>> row_matcher(Product.price >= 1)({"price": Decimal("1.10")})
+    Traceback (most recent call last):
+    ...
+    NotImplementedError: Comparing Decimal with int not supported yet
+
+    >>> from peewee import FloatField
+    >>> class Score(Model):
+    ...     score = FloatField()
+    >>> row_matcher(Score.score > 0.1)
+    Traceback (most recent call last):
+    ...
+    NotImplementedError: Expression [0.1] not supported yet
+
+    Args:
+        exp (Expression): The expression in the where clause
+
+    Raises:
+        NotImplementedError: if the expression is not supported, or, from
+            the predicate, if a row value is not of the constant's type
+
+    Returns:
+        callable: the predicate
+    """
+    if not isinstance(exp, Expression):
+        raise NotImplementedError(f"Expression [{exp}] not supported yet")
+    if exp.op in (OP.AND, OP.OR):
+        lhs, rhs = row_matcher(exp.lhs), row_matcher(exp.rhs)
+        if exp.op == OP.AND:
+            return lambda data: lhs(data) and rhs(data)
+        return lambda data: lhs(data) or rhs(data)
+    if not isinstance(exp.lhs, Field) or isinstance(exp.rhs, Node):
+        raise NotImplementedError(f"Expression [{exp.op}] not supported yet")
+
+    if isinstance(exp.lhs, FloatField):
+        raise NotImplementedError(f"Expression [{exp.rhs}] not supported yet")
+
+    name, db_value = exp.lhs.name, exp.lhs.db_value
+    if exp.op in (OP.IS, OP.IS_NOT) and exp.rhs is None:
+        is_null = exp.op == OP.IS
+        return lambda data: (data.get(name) is None) == is_null
+
+    compare = _MATCH_OPS.get(exp.op)
+    if exp.op in (OP.IN, OP.NOT_IN):
+        rhs = tuple(db_value(value) for value in exp.rhs)
+    else:
+        rhs = db_value(exp.rhs)
+    values = rhs if isinstance(rhs, tuple) else (rhs,)
+    for value in values:
+        if compare is None or value is None or isinstance(value, (str, bytes, float)):
+            raise NotImplementedError(f"Expression [{value}] not supported yet")
+    types = {type(value) for value in values}
+    if len(types) > 1:
+        raise NotImplementedError(f"Expression [{exp.op}] of mixed types")
+
+    def match(data: dict) -> bool:
+        value = data.get(name)
+        if value is None:
+            return False
+        value = db_value(value)
+        if types and type(value) not in types:
+            raise NotImplementedError(
+                f"Comparing {type(value).__name__} with "
+                f"{next(iter(types)).__name__} not supported yet"
+            )
+        return compare(value, rhs)
+
+    return match
 
 
 def field_names(fields: List[Union[Field, str]]) -> List[str]:
@@ -218,11 +442,15 @@ def md5(data: str) -> str:
 
 def flat(items: dict, sep: str = "=", join: str = ":") -> str:
     """Flatten a dictionary to a string. Key and value are separated by `sep`,
-    and each key-value pair is separated by `join`.
+    and each key-value pair is separated by `join`. Pairs are sorted by key,
+    so the same conditions always give the same string.
 
     >>> flat({"a": 1, "b": 2})
     'a=1:b=2'
 
+    >>> flat({"b": 2, "a": 1})
+    'a=1:b=2'
+
     >>> flat({"a": 1, "b": 2}, sep=":", join="=")
     'a:1=b:2'
 
@@ -234,8 +462,12 @@ def flat(items: dict, sep: str = "=", join: str = ":") -> str:
     Returns:
         str: the flattened string
     """
-    items = items or {}
-    return join.join([f"{key}{sep}{value}" for key, value in items.items()])
+    if not items:
+        return ""
+    return join.join(f"{key}{sep}{value}" for key, value in sorted(items.items()))
+
+
+_MISSING = object()
 
 
 def getattrs(obj: Union[dict, object, Expression], names: List[str]) -> dict:
@@ -252,6 +484,12 @@ def getattrs(obj: Union[dict, object, Expression], names: List[str]) -> dict:
     >>> getattrs(User("John", 20), ["name", "age"])
     {'name': 'John', 'age': 20}
 
+    >>> from peewee import CharField, IntegerField
+    >>> class Person(Model):
+    ...     name = CharField()
+    ...     age = IntegerField()
+    >>> getattrs((Person.name == "John") & (Person.age == 0), ["age", "id"])
+    {'age': 0}
 
     Args:
         obj (Union[dict, object, Expression]): the object to
@@ -264,12 +502,36 @@ def getattrs(obj: Union[dict, object, Expression], names: List[str]) -> dict:
     if isinstance(obj, dict):
         return {name: obj.get(name) for name in names if name in obj}
     if isinstance(obj, Expression):
-        return {name: field_eq(obj, name) for name in names if field_eq(obj, name)}
-    return {name: getattr(obj, name) for name in names if hasattr(obj, name)}
-
+        collected = collect_eq(obj)
+        return {name: collected[name] for name in names if name in collected}
+    return {
+        name: value
+        for name in names
+        if (value := getattr(obj, name, _MISSING)) is not _MISSING
+    }
+
+
+class MemoryStore(OrderedDict):
+    """A memory version of Redis store. Every (key, tag) pair is one
+    cached result, and it keeps at most `maxsize` of them, dropping the
+    least recently used one when it is full. A lock guards every operation,
+    since sync handlers share the store across threads.
+
+    >>> m = MemoryStore(maxsize=2)
+    >>> m.hset("a", "tag1", 1)
+    >>> m.hset("a", "tag2", 2)
+    >>> m.hget("a", "tag1")
+    1
+    >>> m.hset("b", "tag", 3)
+    >>> list(m)
+    [('a', 'tag1'), ('b', 'tag')]
+    """
 
-class MemoryStore(dict):
-    """A memory version of Redis store."""
+    def __init__(self, maxsize: int = 100_000):
+        super().__init__()
+        self.maxsize = maxsize
+        self._tags = {}
+        self._lock = threading.Lock()
 
     def hget(self, key: str, tag: str):
         """Get the value of the key and tag from memory store.
@@ -286,7 +548,11 @@ class MemoryStore(dict):
         Returns:
             str: the stored data
         """
-        return self.get(key, {}).get(tag)
+        with self._lock:
+            value = self.get((key, tag))
+            if value is not None:
+                self.move_to_end((key, tag))
+            return value
 
     def hset(self, key: str, tag: str, value: str):
         """Set the value of the key and tag in memory store.
@@ -296,21 +562,28 @@ class MemoryStore(dict):
             tag (str): sub key
             value (str): The value to be set into the memory store
         """
-        self.setdefault(key, {})[tag] = value
+        with self._lock:
+            self[(key, tag)] = value
+            self.move_to_end((key, tag))
+            self._tags.setdefault(key, set()).add(tag)
+            if len(self) > self.maxsize:
+                (old_key, old_tag), _ = self.popitem(last=False)
+                tags = self._tags[old_key]
+                tags.discard(old_tag)
+                if not tags:
+                    del self._tags[old_key]
 
     def delete(self, *keys) -> None:
-        """Delete the specified keys from the memory store.
-        Clear the whole store once for every 1000 calls,
-        to avoid memory leak.
+        """Delete the specified keys, with all their tags, from the memory
+        store.
 
         Args:
             *keys: the keys to be cleared
         """
-        for key in keys:
-            self.pop(key, None)
-
-        if random.randint(1, 1000) == 1:
-            self.clear()
+        with self._lock:
+            for key in keys:
+                for tag in self._tags.pop(key, ()):
+                    self.pop((key, tag), None)
 
 
 class Cache:
@@ -323,6 +596,10 @@ class Cache:
         Redis is preferred sicne MemoryStore can only work on a single
         server. If you are using multiple servers, you should use Redis.
 
+        `delete` is called once with all the keys to clear, so a save
+        costs a single round trip. With Redis, map it to `unlink` to free
+        the memory in the background instead of blocking the server.
+
         Args:
             store (object): MemoryStore or Redis
         """
@@ -354,6 +631,38 @@ class Cache:
         """
         return f"{cls.__name__}:{key}:{flat(sub_keys)}"
 
+    @classmethod
+    def dumps(cls, data: any) -> bytes:
+        """Serialize the data to be stored in cache. Both Redis and
+        MemoryStore take bytes, so it is raw pickle with the fastest and
+        most compact protocol available (5 on Python 3.8+). Out-of-band
+        buffers of protocol 5 are not used: they only apply to PickleBuffer
+        objects, which model rows never contain, and the stores take a
+        single value per tag.
+
+        >>> Cache.loads(Cache.dumps({"a": 1}))
+        {'a': 1}
+
+        Args:
+            data (any): the data to serialize
+
+        Returns:
+            bytes: the serialized data
+        """
+        return pickle.dumps(data, protocol=pickle.HIGHEST_PROTOCOL)
+
+    @classmethod
+    def loads(cls, value: bytes) -> any:
+        """Deserialize the data stored in cache by dumps().
+
+        Args:
+            value (bytes): the serialized data
+
+        Returns:
+            any: the data
+        """
+        return pickle.loads(value)
+
     @classmethod
     def get_cache(
         cls,
@@ -390,17 +699,19 @@ class Cache:
         """
         key = cls.get_key(key, sub_keys)
         if value := cls._store.hget(key, tag):
-            logger.debug(f"Cache HIT {key} {tag} {value[:10]}...")
-            return pickle.loads(value)
+            if logger.isEnabledFor(logging.DEBUG):
+                logger.debug(f"Cache HIT {key} {tag} {value[:10].hex()}...")
+            return cls.loads(value)
 
         data = func(*args, **kwargs)
-        cls._store.hset(key, tag, pickle.dumps(data))
+        cls._store.hset(key, tag, cls.dumps(data))
         logger.debug(f"Cache MISS {key} {tag}")
         return data
 
     @classmethod
     def clear_cache(cls, *keys, raw_key=False):
-        """Clear the cache for the specified keys.
+        """Clear the cache for the specified keys, with a single call to
+        the store's delete.
 
         Args:
             *keys: the keys to be cleared
@@ -408,40 +719,193 @@ class Cache:
             or needs to be prefixed by get_key() . Defaults to False.
         """
         raw_keys = [key if raw_key else cls.get_key(key) for key in keys]
-        for key in raw_keys:
-            logger.debug(f"Cache DELETED {key}")
+        if logger.isEnabledFor(logging.DEBUG):
+            for key in raw_keys:
+                logger.debug(f"Cache DELETED {key}")
         cls._store.delete(*raw_keys)
 
 
 class CachedModelSelect(ModelSelect, Cache):
+    _rows = None
+
     def __iter__(self):
         """Iterate through the results with cache enabled.
 
         The cache key is the model name, suffixed by the indexed fields
-        and values in the where clause. The cache tag is the md5 of the
-        whole SQL text.
+        and values in the where clause. The cache tag is from `cache_tag`.
 
         For example, if the model name is "User", and the where clause
         is "User.id == 1", the cache key is "Cache:User:id=1", and the cache
-        tag is the md5 of the whole SQL text.
+        tag is the digest of the whole SQL.
 
         Following is a sample Cache Key, and Tag:
 
         Key: CachedModelSelect:ChatoDomain:creator=3
         Tag: 65702969e839a655eeaea0e89243efe9
 
+        On a miss, the rows may still be filtered from the cached result of
+        the parent query, see `parent_rows`, before falling back to the
+        database.
+
+        Like peewee keeps the cursor of an executed query, the rows are kept
+        on the query, so iterating it again, or taking its `len`, does not
+        read the cache again. Changing the query makes a clone without them.
+
         Yields:
             list: the results of the SELECT query, served from cache
                 if possible
         """
-        assert len(self._from_list) == 1, "Only one table is allowed by cache"
-        yield from self.get_cache(
-            key=self._from_list[0].__name__,
-            sub_keys=getattrs(self._where, field_names(self.model.index_fields())),
-            tag=md5(str(self)),
-            func=lambda: list(super(ModelSelect, self).__iter__()),
+        yield from self._cached_rows()
+
+    def __len__(self) -> int:
+        """Count the rows through the cache. `list(query)` asks for the
+        length first, which would otherwise run the SQL on the database.
+        """
+        return len(self._cached_rows())
+
+    def clone(self):
+        query = super().clone()
+        query._rows = None
+        return query
+
+    def _cached_rows(self) -> list:
+        if self._rows is None:
+            assert len(self._from_list) == 1, "Only one table is allowed by cache"
+            sub_keys = getattrs(self._where, self.model.index_field_names())
+            tag = self.cache_tag()
+            self._rows = self.get_cache(
+                key=self._from_list[0].__name__,
+                sub_keys=sub_keys,
+                tag=tag,
+                func=lambda: self._fetch(sub_keys, tag),
+            )
+        return self._rows
+
+    def _fetch(self, sub_keys: dict, tag: str) -> list:
+        rows = self.parent_rows(sub_keys, tag)
+        if rows is None:
+            rows = list(super(ModelSelect, self).__iter__())
+        return rows
+
+    def parent_rows(self, sub_keys: dict, tag: str) -> Union[list, None]:
+        """Filter the rows from the cached result of the parent query,
+        the one that only has the indexed "field = value" conditions.
+        For example, `Post.author == 3 AND Post.views > 100` can be served
+        from the cached result of `Post.author == 3`. Both are stored
+        under the same cache key, so a save clears them together.
+
+        Only plain queries of all the fields are served this way, without
+        order, limit, grouping or locking, and only when `row_matcher`
+        supports the where clause.
+
+        Args:
+            sub_keys (dict): the indexed fields and values in the where clause
+            tag (str): the cache tag of this query
+
+        Returns:
+            Union[list, None]: the rows, or None if it can not be served
+
+        >>> from peewee import DecimalField, IntegerField, SqliteDatabase
+        >>> db = SqliteDatabase(":memory:")
+        >>> class Article(Model):
+        ...     author = IntegerField(index=True)
+        ...     views = IntegerField()
+        ...     price = DecimalField()
+        ...     class Meta:
+        ...         database = db
+        >>> db.create_tables([Article])
+        >>> for views in (10, 200):
+        ...     _ = Article.create(author=3, views=views, price="1.10")
+
+        `len` goes through the cache, which now holds the parent query:
+        >>> len(Article.select().where(Article.author == 3).dicts())
+        2
+        >>> query = Article.select().where(
+        ...     (Article.author == 3) & (Article.views > 100)).dicts()
+        >>> [a["views"] for a in query.parent_rows({"author": 3}, query.cache_tag())]
+        [200]
+
+        Decimal against float is left to the database:
+        >>> query = Article.select().where(
+        ...     (Article.author == 3) & (Article.price >= 1.1)).dicts()
+        >>> query.parent_rows({"author": 3}, query.cache_tag()) is None
+        True
+        >>> len(query)
+        2
+        """
+        if not sub_keys or not self._is_plain():
+            return None
+        try:
+            match = row_matcher(self._where)
+        except NotImplementedError:
+            return None
+
+        fields = self.model._meta.fields
+        parent = self.model.select().where(
+            *[fields[name] == value for name, value in sub_keys.items()]
+        )
+        parent._row_type = self._row_type
+        parent_tag = parent.cache_tag()
+        if parent_tag == tag:
+            return None
+        key = self.get_key(self.model.__name__, sub_keys)
+        if not (value := self._store.hget(key, parent_tag)):
+            return None
+
+        logger.debug(f"Cache HIT {key} {parent_tag} (parent of {tag})")
+        rows = self.loads(value)
+        try:
+            if self._row_type == ROW.DICT:
+                return [row for row in rows if match(row)]
+            return [row for row in rows if match(row.__data__)]
+        except (NotImplementedError, TypeError):
+            return None
+
+    def _is_plain(self) -> bool:
+        return (
+            self._is_default
+            and self._row_type in (None, ROW.MODEL, ROW.DICT)
+            and self._from_list == [self.model]
+            and not self._joins
+            and self._limit is None
+            and self._offset is None
+            and not self._order_by
+            and not self._group_by
+            and self._having is None
+            and not self._distinct
+            and not self._simple_distinct
+            and not self._windows
+            and not self._for_update
+            and not self._cte_list
         )
 
+    def cache_tag(self) -> str:
+        """The digest of the row type (model, dicts, tuples...), the SQL
+        template and its parameters. The row type is included since
+        `.dicts()` does not change the SQL but does change the results.
+        The parameters are hashed one by one instead of being formatted
+        into the SQL, which would build a large string for long IN lists.
+
+        Returns:
+            str: the cache tag
+
+        >>> from peewee import CharField
+        >>> class User(Model):
+        ...     name = CharField(max_length=100)
+        >>> tag = User.select().where(User.name == "1").cache_tag()
+        >>> tag == User.select().where(User.name == "1").cache_tag()
+        True
+        >>> tag == User.select().where(User.name == "2").cache_tag()
+        False
+        >>> tag == User.select().where(User.name == "1").dicts().cache_tag()
+        False
+        """
+        sql, params = self.sql()
+        h = hashlib.blake2b(f"{self._row_type}:{sql}".encode("UTF-8"), digest_size=16)
+        for param in params:
+            h.update(b"\0" + repr(param).encode("UTF-8"))
+        return h.hexdigest()
+
     def _call(self, func: str, *expressions):
         """Pass the arguments to the function, and return the result.
         Only call the function if the first expression is not None.
@@ -460,6 +924,15 @@ class CachedModelSelect(ModelSelect, Cache):
 
 
 class CachedModel(PeeweeModel, Cache):
+    @classmethod
+    def validate_model(cls):
+        """Peewee calls this once the model class is fully built. Which
+        fields are indexed never changes, so find them only once.
+        """
+        super().validate_model()
+        cls._index_fields = tuple(f for f in cls._meta.sorted_fields if f.index)
+        cls._index_field_names = tuple(field_names(cls._index_fields))
+
     @classmethod
     def get_by_id(cls, id: int):
         """Get the model by id with cache enabled."""
@@ -477,11 +950,28 @@ class CachedModel(PeeweeModel, Cache):
     @classmethod
     def index_fields(cls) -> List[Field]:
         """Returns a list of fields that are marked as index in the model.
+        It is a copy, so changing it does not affect the cache keys.
 
         Returns:
             List[Field]: the list of fields that are marked as index
         """
-        return [f for f in cls._meta.sorted_fields if f.index]
+        return list(cls._index_fields)
+
+    @classmethod
+    def index_field_names(cls) -> tuple:
+        """Returns the names of the fields that are marked as index.
+
+        >>> from peewee import CharField
+        >>> class User(Model):
+        ...     name = CharField(index=True)
+        ...     mobile = CharField()
+        >>> User.index_field_names()
+        ('name',)
+
+        Returns:
+            tuple: the names of the fields that are marked as index
+        """
+        return cls._index_field_names
 
     def cache_keys(self) -> List[str]:
         """Returns a list of cache keys for the model.
@@ -498,11 +988,33 @@ class CachedModel(PeeweeModel, Cache):
         the SELECT query, the data may be stored in either of the keys. We
         just cleared all the possible combination to be safe - the clear
         operation is cheap in Redis anyway.
+
+        The combinations are enumerated as bitmasks over the `name=value`
+        pairs, which are formatted once and sorted by name, the same way
+        `flat` does. Values are read from `__data__`, so a foreign key is
+        its raw id and the related row is never loaded.
+
+        >>> from peewee import CharField
+        >>> class User(Model):
+        ...     name = CharField(max_length=100, index=True)
+        ...     mobile = CharField(max_length=100, index=True)
+        >>> list(User(id=1, name="John", mobile="123").cache_keys())
+        ['User:1:', 'CachedModelSelect:User:', 'CachedModelSelect:User:mobile=123', 'CachedModelSelect:User:name=John', 'CachedModelSelect:User:mobile=123:name=John']
+
+        >>> from peewee import ForeignKeyField
+        >>> class Post(Model):
+        ...     author = ForeignKeyField(User)
+        >>> list(Post(author=3).cache_keys())
+        ['Post:None:', 'CachedModelSelect:Post:', 'CachedModelSelect:Post:author=3']
         """
         yield self.get_key(self.get_id())
-        for keys in all_combinations(field_names(self.index_fields())):
-            yield CachedModelSelect.get_key(
-                self.__class__.__name__, getattrs(self, keys)
+        prefix = CachedModelSelect.get_key(self.__class__.__name__)
+        names = sorted(self.index_field_names())
+        data = self.__data__
+        pairs = [f"{name}={data.get(name)}" for name in names]
+        for mask in range(1 << len(pairs)):
+            yield prefix + ":".join(
+                pair for i, pair in enumerate(pairs) if mask >> i & 1
             )
 
     @classmethod
@@ -515,9 +1027,10 @@ class CachedModel(PeeweeModel, Cache):
         Returns:
             CachedModelSelect: the CachedModelSelect
         """
+        is_default = not fields
         if not fields:
             fields = cls._meta.sorted_fields
-        return CachedModelSelect(cls, fields)
+        return CachedModelSelect(cls, fields, is_default=is_default)
 
 
 class PermissionedModel(PeeweeModel):
@@ -567,6 +1080,20 @@ class PermissionedModel(PeeweeModel):
     default_field_permission = 0o604  # OWNER READ WRITE, OTHER READ
     default_role = 0o007  # OTHER
 
+    @classmethod
+    def validate_model(cls):
+        """Peewee calls this once the model class is fully built.
+        Permissions are static for a model class, so compute them once,
+        and give each class its own caches of the permitted fields and
+        their names per role.
+        """
+        super().validate_model()
+        cls._model_perm = getattr(cls._meta, "permission", cls.default_model_permission)
+        cls._field_perms = {f: cls.field_perm(f) for f in cls._meta.sorted_fields}
+        cls._fields_cache = {}
+        cls._readable_cache = {}
+        cls._writable_cache = {}
+
     def get_role(self, user_id: int) -> int:
         """The role of the user. It is used to determine the permission
         of the user. Override this function to implement your own role
@@ -583,7 +1110,9 @@ class PermissionedModel(PeeweeModel):
     @classmethod
     def fields(cls, op_perm: int = 0, role: int = 0) -> List[Field]:
         """Returns a list of fields that the user has the permission
-        to read/write.
+        to read/write. The permissions are static, so the fields are
+        filtered once per (op_perm, role) and then served from the class
+        cache.
 
         Args:
             op_perm (int, optional): the required permission. Defaults to 0.
@@ -605,16 +1134,20 @@ class PermissionedModel(PeeweeModel):
         >>> User.fields(op_perm=0o200, role=0o700)
         [<AutoField: User.id>, <CharField: User.name>, <CharField: User.mobile>]
         """
-
-        return [
-            field
-            for field, permission in cls.field_perms().items()
-            if permission & op_perm & role
-        ]
+        fields = cls._fields_cache.get((op_perm, role))
+        if fields is None:
+            fields = tuple(
+                field
+                for field, permission in cls._field_perms.items()
+                if permission & op_perm & role
+            )
+            cls._fields_cache[(op_perm, role)] = fields
+        return list(fields)
 
     @classmethod
     def field_perms(cls) -> Dict[Field, int]:
-        """Returns a dict of fields and their permission.
+        """Returns a dict of fields and their permission. It is a copy, so
+        changing it does not affect the permissions of the model.
 
         Returns:
             Dict[Field, int]: a dict of fields and their permission
@@ -629,8 +1162,12 @@ class PermissionedModel(PeeweeModel):
 
         >>> User.field_perms()
         {<AutoField: User.id>: 384, <CharField: User.name>: 384, <CharField: User.mobile>: 384, <CharField: User.role>: 256}
+
+        >>> User.field_perms()[User.mobile] = 0o777
+        >>> User.field_perms()[User.mobile]
+        384
         """
-        return {f: cls.field_perm(f) for f in cls._meta.sorted_fields}
+        return dict(cls._field_perms)
 
     @classmethod
     def field_perm(cls, field: Field) -> int:
@@ -669,7 +1206,97 @@ class PermissionedModel(PeeweeModel):
         '0o604'
         """
 
-        return getattr(cls._meta, "permission", cls.default_model_permission)
+        return cls._model_perm
+
+    @classmethod
+    def readable_names(cls, role: int) -> tuple:
+        """Returns the names of the fields readable by the role, in field
+        order. Permissions are static for a model class, so it is computed
+        once per role and served from the class cache of dict_names.
+
+        Args:
+            role (int): the role of the user
+
+        Returns:
+            tuple: the names of the readable fields
+
+        >>> from peewee import CharField
+        >>> class User(Model):
+        ...     name = CharField(max_length=100, _hidden=0o604)
+        ...     mobile = CharField(max_length=100, _hidden=0o600)
+        >>> User.readable_names(0o007)
+        ('id', 'name')
+        >>> User.readable_names(0o700)
+        ('id', 'name', 'mobile')
+        """
+        return cls.dict_names(role)
+
+    @classmethod
+    def dict_names(cls, role: int, only: tuple = (), exclude: tuple = ()) -> tuple:
+        """Returns the names of the fields to_dict returns for the role,
+        narrowed by the `only` and `exclude` names. A list endpoint asks
+        for the same names on every row, so the result is cached per class.
+        `only` and `exclude` come from requests, so the cache stops growing
+        at 1024 entries.
+
+        Args:
+            role (int): the role of the user
+            only (tuple, optional): the names to be included. Defaults to
+                (), which means all readable fields.
+            exclude (tuple, optional): the names to be excluded. Defaults
+                to ().
+
+        Returns:
+            tuple: the names of the fields, in field order
+
+        >>> from peewee import CharField
+        >>> class User(Model):
+        ...     name = CharField(max_length=100, _hidden=0o604)
+        ...     mobile = CharField(max_length=100, _hidden=0o600)
+        >>> User.dict_names(0o700, ("mobile", "name"), ("name",))
+        ('mobile',)
+        """
+        names = cls._readable_cache.get((role, only, exclude))
+        if names is not None:
+            return names
+
+        names = tuple(field_names(cls.fields(0o444, role)))
+        if only:
+            included = set(only)
+            names = tuple(name for name in names if name in included)
+        if exclude:
+            excluded = set(exclude)
+            names = tuple(name for name in names if name not in excluded)
+        if len(cls._readable_cache) < 1024:
+            cls._readable_cache[(role, only, exclude)] = names
+        return names
+
+    @classmethod
+    def writable_names(cls, role: int) -> frozenset:
+        """Returns the names of the fields writable by the role, cached per
+        role like readable_names. It is a set as it is only used for
+        membership tests.
+
+        Args:
+            role (int): the role of the user
+
+        Returns:
+            frozenset: the names of the writable fields
+
+        >>> from peewee import CharField
+        >>> class User(Model):
+        ...     name = CharField(max_length=100, _hidden=0o606)
+        ...     mobile = CharField(max_length=100, _hidden=0o600)
+        >>> sorted(User.writable_names(0o007))
+        ['name']
+        >>> sorted(User.writable_names(0o700))
+        ['id', 'mobile', 'name']
+        """
+        names = cls._writable_cache.get(role)
+        if names is None:
+            names = frozenset(field_names(cls.fields(0o222, role)))
+            cls._writable_cache[role] = names
+        return names
 
     def readable_fields(self, user_id: int = 0) -> List[Field]:
         """Get a list of readable fields for the current user
@@ -718,6 +1345,10 @@ class PermissionedModel(PeeweeModel):
         """Returns a dict of the model. Only the fields that the user
         has the permission to read will be included.
 
+        Values are read straight from `__data__`, so a foreign key is
+        returned as its raw value, and never triggers a query to load the
+        related object.
+
         Args:
             user_id (int, optional): the user id. Defaults to 0.
             only (List[Union[Field, str]], optional): the list of fields
@@ -752,15 +1383,20 @@ class PermissionedModel(PeeweeModel):
         The mobile is not available for OTHER user, and name is excluded:
         >>> user.to_dict(user_id=0, exclude=["name"])
         {'role': 'user'}
+
+        The foreign key is the raw id, the author is not loaded:
+        >>> from peewee import ForeignKeyField
+        >>> class Post(Model):
+        ...     author = ForeignKeyField(User)
+        >>> Post(author=3).to_dict()
+        {'author': 3}
         """
-        readable_fields = [
-            field
-            for field in field_names(self.readable_fields(user_id))
-            if (only is None or not any(only) or field in field_names(only))
-            and (exclude is None or field not in field_names(exclude))
-        ]
+        only = tuple(field_names(only)) if only and any(only) else ()
+        exclude = tuple(field_names(exclude)) if exclude else ()
+        names = self.dict_names(self.get_role(user_id), only, exclude)
 
-        return getattrs(self.__data__, readable_fields)
+        data = self.__data__
+        return {name: data[name] for name in names if name in data}
 
     def from_dict(self, items: dict, user_id: int = 0) -> "PermissionedModel":
         """Update the model from a dict. Only the fields that the user
@@ -798,13 +1434,15 @@ class PermissionedModel(PeeweeModel):
         PermissionError: Field name is not writable for user 1 (role 0o7)
 
         """
+        role = self.get_role(user_id)
+        writable = self.writable_names(role)
         for key, value in items.items():
-            if key in field_names(self.writable_fields(user_id)):
+            if key in writable:
                 setattr(self, key, value)
             else:
                 raise PermissionError(
                     f"Field {key} is not writable for user "
-                    f"{user_id} (role {oct(self.get_role(user_id))})"
+                    f"{user_id} (role {oct(role)})"
                 )
         return self
 